@@ -0,0 +1,93 @@
+# Times the NumPy report engine in reports.py on synthetic order lines, no database needed: the
+# conversion of database rows into arrays (from_rows()) and the grouping (aggregate()).
+# --database-url also times report_lines(), the read of every order line from a seeded database
+# (see `flask seed`) that /reports/sales and `flask report` start with.
+#
+#   python benchmarks/reports_benchmark.py --lines 10000000
+#   python benchmarks/reports_benchmark.py --lines 1000000 --database-url sqlite:////tmp/seeded.db
+import argparse
+import os
+import sys
+import time
+from datetime import date
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import reports
+
+
+# skewed like real sales: a few products and customers account for most lines
+def synthetic_lines(count, products, customers, days, seed):
+  random = np.random.default_rng(seed)
+  order_ids = np.sort(random.integers(1, max(2, count // 5), count)).astype(np.int64)
+  return {
+    "order_id": order_ids,
+    "product_id": (random.zipf(1.3, count) % products + 1).astype(np.int32),
+    "customer_id": (random.zipf(1.5, count) % customers + 1).astype(np.int32),
+    "quantity": random.integers(1, 6, count).astype(np.int32),
+    "price": np.round(random.uniform(1, 200, count), 2),
+    "day": np.datetime64("2024-01-01") + random.integers(0, days, count).astype("timedelta64[D]"),
+  }
+
+
+# report_lines() hands every chunk the database returns to from_rows() as Python tuples. The lines
+# are turned back into tuples chunk by chunk first, only from_rows() and concat() are timed
+def time_from_rows(lines, chunk_size):
+  elapsed = 0.0
+  chunks = []
+  for start in range(0, len(lines["order_id"]), chunk_size):
+    part = {name: column[start:start + chunk_size] for name, column in lines.items()}
+    rows = list(zip(part["order_id"].tolist(), part["product_id"].tolist(), part["customer_id"].tolist(),
+      part["quantity"].tolist(), part["price"].tolist(), part["day"].astype("datetime64[s]").tolist()))
+    began = time.perf_counter()
+    chunks.append(reports.from_rows(rows))
+    elapsed += time.perf_counter() - began
+  began = time.perf_counter()
+  reports.concat(chunks)
+  return elapsed + time.perf_counter() - began
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Report engine throughput on synthetic order lines")
+  parser.add_argument("--lines", type=int, default=10_000_000)
+  parser.add_argument("--products", type=int, default=100_000)
+  parser.add_argument("--customers", type=int, default=1_000_000)
+  parser.add_argument("--days", type=int, default=365)
+  parser.add_argument("--seed", type=int, default=1)
+  parser.add_argument("--chunk-size", type=int, default=50_000, help="rows per chunk, like REPORT_CHUNK_SIZE")
+  parser.add_argument("--database-url", help="also time report_lines() against this seeded database")
+  args = parser.parse_args()
+
+  began = time.perf_counter()
+  lines = synthetic_lines(args.lines, args.products, args.customers, args.days, args.seed)
+  print("generated %d lines in %.2fs" % (args.lines, time.perf_counter() - began))
+
+  elapsed = time_from_rows(lines, args.chunk_size)
+  print("from_rows %d lines  %6.2fs  %6.1fM lines/s" % (args.lines, elapsed, args.lines / elapsed / 1e6))
+
+  for by in reports.groupings:
+    began = time.perf_counter()
+    result = reports.aggregate(lines, by, percentiles=(50, 90, 99))
+    top = reports.top_n(result, "revenue", 10)
+    elapsed = time.perf_counter() - began
+    print("by %-8s %8d groups  %6.2fs  %6.1fM lines/s  top revenue %.2f" % (
+      by, len(result["group"]), elapsed, args.lines / elapsed / 1e6, top["revenue"][0]))
+
+  if args.database_url:
+    from app import create_app, report_lines
+    app = create_app({"SQLALCHEMY_DATABASE_URI": args.database_url, "REPORT_CHUNK_SIZE": args.chunk_size})
+    with app.app_context():
+      began = time.perf_counter()
+      lines = report_lines(reports, date(1970, 1, 1), date.today())
+      elapsed = time.perf_counter() - began
+      count = len(lines["order_id"])
+      print("report_lines %d lines from the database  %6.2fs  %6.1fM lines/s" % (count, elapsed, count / max(elapsed, 1e-9) / 1e6))
+      began = time.perf_counter()
+      result = reports.aggregate(lines, "product", percentiles=(50, 90, 99))
+      print("by product %8d groups  %6.2fs" % (len(result["group"]), time.perf_counter() - began))
+
+
+if __name__ == "__main__":
+  main()
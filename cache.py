@@ -0,0 +1,147 @@
+#------------------------------------------------------------------------------------------------------
+#                                   Product Cache
+# read-through cache for serialized products. Any object with get/version/set/invalidate/clear (see
+# LocalCache) can be plugged in as the backend with the PRODUCT_CACHE_BACKEND setting, LocalCache is
+# the default and the stand-in for a shared cache when testing. app.py loads the products and
+# invalidates them after writes.
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+class LocalCache:
+  # in-process LRU cache, every entry also expires after ttl seconds. Only this process's writes
+  # invalidate it, so one generation number for the whole cache is enough: a load that started
+  # before any invalidation isn't stored
+  def __init__(self, max_entries, ttl):
+    self.max_entries = max_entries
+    self.ttl = ttl
+    self.entries = OrderedDict()
+    self.generation = 0
+    self.lock = threading.Lock()
+
+  def get(self, key):
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is None:
+        return None
+      value, expires = entry
+      if expires < time.monotonic():
+        del self.entries[key]
+        return None
+      self.entries.move_to_end(key)
+      return value
+
+  def version(self, key):
+    return self.generation
+
+  def set(self, key, value, version):
+    with self.lock:
+      if version != self.generation:
+        return
+      self.entries[key] = (value, time.monotonic() + self.ttl)
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.max_entries:
+        self.entries.popitem(last=False)
+
+  def invalidate(self, key):
+    with self.lock:
+      self.generation += 1
+      self.entries.pop(key, None)
+
+  def clear(self):
+    with self.lock:
+      self.generation += 1
+      self.entries.clear()
+
+
+class RedisCache:
+  # cache shared by every worker, needs the optional redis package. Each product has a version
+  # counter next to its entry that every invalidation bumps, and one more counter is bumped by
+  # clear(). A load is stored only if neither moved since it started, checked and stored in one
+  # script so a write in another worker can't land in between. The counters expire with the
+  # entries, a load takes far less than the TTL.
+  set_script = """
+    local version = (redis.call('get', KEYS[2]) or '0') .. ':' .. (redis.call('get', KEYS[3]) or '0')
+    if version == ARGV[2] then
+      redis.call('set', KEYS[1], ARGV[1], 'EX', ARGV[3])
+    end
+  """
+
+  def __init__(self, url, ttl, prefix="product:"):
+    import redis
+    self.client = redis.Redis.from_url(url)
+    self.ttl = ttl
+    self.prefix = prefix
+    self.store = self.client.register_script(self.set_script)
+
+  def keys(self, key):
+    return [self.prefix + str(key), self.prefix + "version:" + str(key), self.prefix + "clears"]
+
+  def get(self, key):
+    value = self.client.get(self.prefix + str(key))
+    return None if value is None else json.loads(value)
+
+  def version(self, key):
+    versions = self.client.mget(self.keys(key)[1:])
+    return ":".join((version or b"0").decode() for version in versions)
+
+  def set(self, key, value, version):
+    self.store(keys=self.keys(key), args=[json.dumps(value), version, self.ttl])
+
+  def invalidate(self, key):
+    entry, version, clears = self.keys(key)
+    with self.client.pipeline() as pipeline:
+      pipeline.incr(version)
+      pipeline.expire(version, self.ttl)
+      pipeline.delete(entry)
+      pipeline.execute()
+
+  def clear(self):
+    self.client.incr(self.prefix + "clears")
+    for key in self.client.scan_iter(self.prefix + "*"):
+      if key.decode() != self.prefix + "clears":
+        self.client.delete(key)
+
+
+class ProductCache:
+  # config is the app's config, read when the backend is first needed so tests can still change it
+  def __init__(self, config):
+    self.config = config
+    self.backend = None
+    self.hits = 0
+    self.misses = 0
+
+  def get_backend(self):
+    if self.backend is None:
+      if self.config.get("PRODUCT_CACHE_BACKEND") is not None:
+        self.backend = self.config["PRODUCT_CACHE_BACKEND"]
+      elif self.config["PRODUCT_CACHE_REDIS_URL"]:
+        self.backend = RedisCache(self.config["PRODUCT_CACHE_REDIS_URL"], self.config["PRODUCT_CACHE_TTL"])
+      else:
+        self.backend = LocalCache(self.config["PRODUCT_CACHE_SIZE"], self.config["PRODUCT_CACHE_TTL"])
+    return self.backend
+
+  def load(self, product_id, loader):
+    backend = self.get_backend()
+    data = backend.get(product_id)
+    if data is not None:
+      self.hits += 1
+      return data
+    self.misses += 1
+    # the backend doesn't store what we read if the product was invalidated in the meantime, the
+    # write that did it may have been committed after our read
+    version = backend.version(product_id)
+    data = loader()
+    backend.set(product_id, data, version)
+    return data
+
+  # called after the write has been committed
+  def invalidate(self, *product_ids):
+    backend = self.get_backend()
+    for product_id in product_ids:
+      backend.invalidate(product_id)
+
+  def clear(self):
+    self.get_backend().clear()
@@ -0,0 +1,135 @@
+#------------------------------------------------------------------------------------------------------
+#                                   Request Metrics
+# request counts, latency and response size histograms and in-flight requests, per endpoint, in the
+# Prometheus text format. Every thread records into its own shard so recording a request takes no
+# lock and threads never write to the same counters. A scrape adds the shards up, and folds the
+# shards of threads that have exited into one so a server that starts a thread per request doesn't
+# collect shards forever. app.py records each request and serves /metrics.
+import bisect
+import threading
+
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+size_buckets = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+
+class Shard:
+  def __init__(self):
+    self.in_flight = 0
+    # (endpoint, method, status) -> requests
+    self.requests = {}
+    # endpoint -> [count in each bucket (the last one is +Inf), sum]
+    self.latency = {}
+    self.sizes = {}
+
+  # other's owner may still be recording, list() copies a dict or a histogram in one step
+  # while looping over the live dict would fail once the owner adds a key
+  def merge(self, other):
+    self.in_flight += other.in_flight
+    for key, count in list(other.requests.items()):
+      self.requests[key] = self.requests.get(key, 0) + count
+    for mine, theirs in ((self.latency, other.latency), (self.sizes, other.sizes)):
+      for key, histogram in list(theirs.items()):
+        histogram = list(histogram)
+        if key in mine:
+          mine[key] = [a + b for a, b in zip(mine[key], histogram)]
+        else:
+          mine[key] = histogram
+
+
+def observe(histograms, buckets, key, value):
+  histogram = histograms.get(key)
+  if histogram is None:
+    histogram = histograms[key] = [0] * (len(buckets) + 2)
+  histogram[bisect.bisect_left(buckets, value)] += 1
+  histogram[-1] += value
+
+
+class Metrics:
+  def __init__(self):
+    self.local = threading.local()
+    self.lock = threading.Lock()
+    # (thread, shard) for every thread that recorded something, and what the exited ones recorded
+    self.shards = []
+    self.retired = Shard()
+
+  def shard(self):
+    shard = getattr(self.local, "shard", None)
+    if shard is None:
+      shard = self.local.shard = Shard()
+      with self.lock:
+        self.shards.append((threading.current_thread(), shard))
+    return shard
+
+  def started(self):
+    self.shard().in_flight += 1
+
+  def finished(self):
+    self.shard().in_flight -= 1
+
+  def record(self, endpoint, method, status, seconds, size):
+    shard = self.shard()
+    key = (endpoint, method, status)
+    shard.requests[key] = shard.requests.get(key, 0) + 1
+    observe(shard.latency, latency_buckets, endpoint, seconds)
+    if size is not None:
+      observe(shard.sizes, size_buckets, endpoint, size)
+
+  def collect(self):
+    with self.lock:
+      live = []
+      for thread, shard in self.shards:
+        if thread.is_alive():
+          live.append((thread, shard))
+        else:
+          self.retired.merge(shard)
+      self.shards = live
+      total = Shard()
+      total.merge(self.retired)
+      for thread, shard in live:
+        total.merge(shard)
+    return total
+
+
+def escape(value):
+  return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def labels(**values):
+  return "{%s}" % ",".join('%s="%s"' % (name, escape(value)) for name, value in values.items())
+
+def histogram_lines(name, buckets, histograms):
+  lines = []
+  for endpoint, histogram in sorted(histograms.items()):
+    cumulative = 0
+    for bound, count in zip(buckets + ("+Inf",), histogram):
+      cumulative += count
+      lines.append("%s_bucket%s %d" % (name, labels(endpoint=endpoint, le=bound), cumulative))
+    lines.append("%s_sum%s %s" % (name, labels(endpoint=endpoint), repr(float(histogram[-1]))))
+    lines.append("%s_count%s %d" % (name, labels(endpoint=endpoint), cumulative))
+  return lines
+
+# families is a list of (name, type, help, [(label dict, value)]) for the gauges and counters app.py adds
+def render(total, families=()):
+  lines = [
+    "# HELP http_requests_total Requests handled, by endpoint, method and status.",
+    "# TYPE http_requests_total counter",
+  ]
+  for (endpoint, method, status), count in sorted(total.requests.items()):
+    lines.append("http_requests_total%s %d" % (labels(endpoint=endpoint, method=method, status=status), count))
+  lines += [
+    "# HELP http_request_duration_seconds Time from the start of a request to its response.",
+    "# TYPE http_request_duration_seconds histogram",
+  ] + histogram_lines("http_request_duration_seconds", latency_buckets, total.latency)
+  lines += [
+    "# HELP http_response_size_bytes Size of response bodies, streamed responses are left out.",
+    "# TYPE http_response_size_bytes histogram",
+  ] + histogram_lines("http_response_size_bytes", size_buckets, total.sizes)
+  lines += [
+    "# HELP http_requests_in_flight Requests being handled right now.",
+    "# TYPE http_requests_in_flight gauge",
+    "http_requests_in_flight %d" % total.in_flight,
+  ]
+  for name, kind, help, samples in families:
+    lines += ["# HELP %s %s" % (name, help), "# TYPE %s %s" % (name, kind)]
+    for sample_labels, value in samples:
+      lines.append("%s%s %s" % (name, labels(**sample_labels) if sample_labels else "", value))
+  return "\n".join(lines) + "\n"
@@ -0,0 +1,107 @@
+#------------------------------------------------------------------------------------------------------
+#                                   Connection Pool Telemetry
+# a QueuePool that keeps count of what happens when connections are handed out: how long callers
+# waited for one, how often the pool had to open an overflow connection, checkouts that timed out,
+# new connections and invalidated ones (a connection that fails its pre-ping shows up as an
+# invalidation). app.py makes it the engine's poolclass and serves the numbers from /admin/pool.
+import threading
+import time
+
+from sqlalchemy import event, exc
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+
+# options only a QueuePool takes, a StaticPool fails on pool_size and recycling its one connection would lose the data
+queue_pool_options = ("poolclass", "pool_size", "max_overflow", "pool_timeout", "pool_recycle")
+
+
+class PoolStats:
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.checkouts = 0
+    self.wait_total = 0.0
+    self.wait_max = 0.0
+    self.overflow_events = 0
+    self.timeouts = 0
+    self.connects = 0
+    self.invalidations = 0
+
+  def checkout(self, wait, overflowed):
+    with self.lock:
+      self.checkouts += 1
+      self.wait_total += wait
+      self.wait_max = max(self.wait_max, wait)
+      if overflowed:
+        self.overflow_events += 1
+
+  def timeout(self, wait):
+    with self.lock:
+      self.timeouts += 1
+      self.wait_total += wait
+      self.wait_max = max(self.wait_max, wait)
+
+  # pool event listeners
+  def connect(self, *args):
+    with self.lock:
+      self.connects += 1
+
+  def invalidate(self, *args):
+    with self.lock:
+      self.invalidations += 1
+
+  def snapshot(self):
+    with self.lock:
+      return {
+        "checkouts": self.checkouts,
+        "wait_ms_total": round(self.wait_total * 1000, 3),
+        "wait_ms_average": round(self.wait_total * 1000 / (self.checkouts + self.timeouts), 3) if self.checkouts + self.timeouts else 0,
+        "wait_ms_max": round(self.wait_max * 1000, 3),
+        "overflow_events": self.overflow_events,
+        "timeouts": self.timeouts,
+        "connects": self.connects,
+        "invalidations": self.invalidations,
+      }
+
+
+# an in-memory SQLite database lives in one connection, Flask-SQLAlchemy gives it a StaticPool
+# instead of a QueuePool, so it gets the engine options without the pool settings
+def in_memory(url):
+  url = make_url(url)
+  return url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:")
+
+def engine_options(url, options):
+  if in_memory(url):
+    return {name: value for name, value in options.items() if name not in queue_pool_options}
+  return options
+
+
+class InstrumentedQueuePool(QueuePool):
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    # engine.dispose() builds a new pool, so the counts start again from zero
+    self.stats = PoolStats()
+    # QueuePool._do_get calls itself again when it loses a race for an overflow slot, only the outer call counts
+    self.local = threading.local()
+    event.listen(self, "connect", self.stats.connect)
+    event.listen(self, "invalidate", self.stats.invalidate)
+
+  def _do_get(self):
+    if getattr(self.local, "inside", False):
+      return super()._do_get()
+    start = time.perf_counter()
+    overflow = self.overflow()
+    self.local.inside = True
+    try:
+      connection = super()._do_get()
+    except exc.TimeoutError:
+      self.stats.timeout(time.perf_counter() - start)
+      raise
+    finally:
+      self.local.inside = False
+    # overflow() counts up from -pool_size, only connections past pool_size are overflow
+    self.stats.checkout(time.perf_counter() - start, self.overflow() > max(overflow, 0))
+    return connection
+
+  def telemetry(self):
+    return dict(size=self.size(), checked_out=self.checkedout(), checked_in=self.checkedin(),
+      overflow=max(self.overflow(), 0), **self.stats.snapshot())
@@ -0,0 +1,88 @@
+#------------------------------------------------------------------------------------------------------
+#                                   Sampling Profiler
+# a background thread that wakes every interval while requests are being profiled, reads the stack of
+# each of their threads from sys._current_frames() and counts it under the request's endpoint. Nothing
+# runs inside the profiled request itself besides begin() and end(), and the thread sleeps when no
+# request is being profiled. Stacks come out in the collapsed format ("outer;inner;leaf count" per
+# line) that flamegraph.pl, speedscope and most other flamegraph tools read. app.py picks the
+# requests to profile and serves the stacks from /admin/profiles.
+import os
+import sys
+import threading
+import time
+
+# stands in for the stacks past max_stacks for one endpoint
+other_stacks = ("[other stacks]",)
+
+
+def frame_name(code):
+  if isinstance(code, str):
+    return code
+  return "%s (%s:%d)" % (getattr(code, "co_qualname", code.co_name), os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+class Profiler(threading.Thread):
+  def __init__(self, interval, max_stacks):
+    super().__init__(name="profiler", daemon=True)
+    self.interval = interval
+    self.max_stacks = max_stacks
+    self.lock = threading.Lock()
+    # thread id -> endpoint of the request it is handling
+    self.active = {}
+    self.busy = threading.Event()
+    # endpoint -> {stack (tuple of code objects, outermost first): samples}
+    self.stacks = {}
+    # endpoint -> [requests profiled, samples taken]
+    self.counts = {}
+
+  def begin(self, endpoint):
+    with self.lock:
+      self.active[threading.get_ident()] = endpoint
+      self.counts.setdefault(endpoint, [0, 0])[0] += 1
+      self.busy.set()
+
+  def end(self):
+    with self.lock:
+      if self.active.pop(threading.get_ident(), None) is not None and not self.active:
+        self.busy.clear()
+
+  def sample(self):
+    frames = sys._current_frames()
+    with self.lock:
+      for ident, endpoint in self.active.items():
+        frame = frames.get(ident)
+        stack = []
+        while frame is not None:
+          stack.append(frame.f_code)
+          frame = frame.f_back
+        if not stack:
+          continue
+        stack = tuple(reversed(stack))
+        stacks = self.stacks.setdefault(endpoint, {})
+        if stack not in stacks and len(stacks) >= self.max_stacks:
+          stack = other_stacks
+        stacks[stack] = stacks.get(stack, 0) + 1
+        self.counts[endpoint][1] += 1
+
+  def run(self):
+    while True:
+      self.busy.wait()
+      time.sleep(self.interval)
+      self.sample()
+
+  def summary(self):
+    with self.lock:
+      return {endpoint: {"requests": requests, "samples": samples} for endpoint, (requests, samples) in self.counts.items()}
+
+  # the endpoint's stacks in collapsed format, most sampled first, None when it has none
+  def collapsed(self, endpoint):
+    with self.lock:
+      stacks = sorted(self.stacks.get(endpoint, {}).items(), key=lambda item: -item[1])
+    if not stacks:
+      return None
+    return "".join("%s %d\n" % (";".join(frame_name(code) for code in stack), samples) for stack, samples in stacks)
+
+  def reset(self):
+    with self.lock:
+      self.stacks = {}
+      self.counts = {endpoint: [0, 0] for endpoint in self.active.values()}
@@ -0,0 +1,69 @@
+#------------------------------------------------------------------------------------------------------
+#                                   Query Stats
+# counts the SQL statements run while a request is handled, the time spent in them, and how many times
+# each statement ran. The same statement running again and again with different parameters is what an
+# N+1 looks like: one query for a list, then one more for every row in it. app.py starts a QueryStats
+# for each request, reports it in response headers and the log, and in strict mode fails the request.
+import contextvars
+import time
+
+from sqlalchemy import event
+
+# the stats of the request being handled in this thread, None outside a request (and in the background threads)
+current = contextvars.ContextVar("query_stats", default=None)
+
+
+class RepeatedQueryError(AssertionError):
+  pass
+
+
+class QueryStats:
+  def __init__(self):
+    self.count = 0
+    self.seconds = 0.0
+    # statement -> [times run, seconds]
+    self.statements = {}
+
+  def record(self, statement, seconds):
+    self.count += 1
+    self.seconds += seconds
+    entry = self.statements.get(statement)
+    if entry is None:
+      self.statements[statement] = [1, seconds]
+    else:
+      entry[0] += 1
+      entry[1] += seconds
+
+  def most_repeated(self):
+    return max((count for count, seconds in self.statements.values()), default=0)
+
+  # statements that ran threshold times or more, most repeated first
+  def repeated(self, threshold):
+    found = [(statement, count, seconds) for statement, (count, seconds) in self.statements.items() if count >= threshold]
+    return sorted(found, key=lambda item: -item[1])
+
+
+def start():
+  stats = QueryStats()
+  current.set(stats)
+  return stats
+
+def stop():
+  current.set(None)
+
+
+# engine event listeners, an executemany counts as one statement as it is one round trip
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+  if current.get() is not None:
+    context.query_started = time.perf_counter()
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+  stats = current.get()
+  started = getattr(context, "query_started", None)
+  if stats is not None and started is not None:
+    stats.record(statement, time.perf_counter() - started)
+
+def instrument(engine):
+  if not event.contains(engine, "before_cursor_execute", before_cursor_execute):
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", after_cursor_execute)
@@ -0,0 +1,118 @@
+#------------------------------------------------------------------------------------------------------
+#                                   Order Line Reports
+# order lines are held column by column in NumPy arrays and every report is computed with vectorized
+# operations (unique/bincount/lexsort) instead of looping over rows in Python, so reports over
+# millions of Order_Product rows take seconds. app.py loads the lines in chunks and serves the
+# results from /reports/sales and `flask report`. NumPy is only needed when a report is run.
+import numpy as np
+
+columns = ("order_id", "product_id", "customer_id", "quantity", "price", "day")
+dtypes = {
+  "order_id": np.int64,
+  "product_id": np.int32,
+  "customer_id": np.int32,
+  "quantity": np.int32,
+  "price": np.float64,
+  "day": "datetime64[D]",
+}
+groupings = ("product", "customer", "day", "week", "month", "all")
+metrics = ("revenue", "units", "lines", "orders")
+
+# rows are (order_id, product_id, customer_id, quantity, price, order_date) tuples from one chunk
+def from_rows(rows):
+  values = list(zip(*rows)) if rows else [()] * len(columns)
+  lines = {}
+  for name, column in zip(columns, values):
+    if name == "customer_id":
+      column = [-1 if value is None else value for value in column]
+    elif name == "price":
+      column = [0.0 if value is None else value for value in column]
+    lines[name] = np.array(column, dtype=dtypes[name])
+  return lines
+
+def concat(chunks):
+  chunks = list(chunks)
+  if not chunks:
+    return from_rows([])
+  return {name: np.concatenate([chunk[name] for chunk in chunks]) for name in columns}
+
+def group_keys(lines, by):
+  if by == "product":
+    return lines["product_id"]
+  if by == "customer":
+    return lines["customer_id"]
+  if by == "day":
+    return lines["day"]
+  if by == "week":
+    # 1970-01-01 was a Thursday, shifting by three days makes the weeks start on Monday
+    return ((lines["day"] + np.timedelta64(3, "D")).astype("datetime64[W]") - np.timedelta64(3, "D")).astype("datetime64[D]")
+  if by == "month":
+    return lines["day"].astype("datetime64[M]")
+  if by == "all":
+    return np.zeros(len(lines["order_id"]), dtype=np.int8)
+  raise ValueError("Unknown grouping %r" % by)
+
+# percentiles (linear interpolation) of values within each group for every q, all groups at once
+def grouped_percentiles(inverse, values, group_count, qs):
+  ordered = values[np.lexsort((values, inverse))]
+  sizes = np.bincount(inverse, minlength=group_count)
+  starts = np.cumsum(sizes) - sizes
+  result = {}
+  for q in qs:
+    positions = (sizes - 1) * (q / 100.0)
+    low = np.floor(positions).astype(np.int64)
+    high = np.ceil(positions).astype(np.int64)
+    result[q] = ordered[starts + low] + (ordered[starts + high] - ordered[starts + low]) * (positions - low)
+  return result
+
+# units, revenue, line and order counts per group, plus percentiles of line revenue within each group
+def aggregate(lines, by, percentiles=()):
+  keys = group_keys(lines, by)
+  groups, inverse = np.unique(keys, return_inverse=True)
+  inverse = inverse.ravel()
+  count = len(groups)
+  revenue = lines["quantity"] * lines["price"]
+  result = {
+    "group": groups,
+    "units": np.bincount(inverse, weights=lines["quantity"], minlength=count).astype(np.int64),
+    "revenue": np.bincount(inverse, weights=revenue, minlength=count),
+    "lines": np.bincount(inverse, minlength=count),
+  }
+  # an order counts once per group however many of its lines fall in it
+  span = int(lines["order_id"].max(initial=0)) + 1
+  pairs = np.sort(inverse.astype(np.int64) * span + lines["order_id"])
+  first = np.ones(len(pairs), dtype=bool)
+  first[1:] = pairs[1:] != pairs[:-1]
+  result["orders"] = np.bincount(pairs[first] // span, minlength=count)
+  if percentiles and count:
+    for q, values in grouped_percentiles(inverse, revenue, count, percentiles).items():
+      result["p%g" % q] = values
+  return result
+
+# the n groups with the largest metric, largest first
+def top_n(result, metric, n):
+  values = result[metric]
+  if n < len(values):
+    picked = np.argpartition(-values, n - 1)[:n]
+  else:
+    picked = np.arange(len(values))
+  picked = picked[np.argsort(-values[picked], kind="stable")]
+  return {name: column[picked] for name, column in result.items()}
+
+# plain Python records for JSON, dates come out as ISO strings ("2024-05" for months)
+def to_records(result, by):
+  result = dict(result)
+  if by in ("day", "week", "month"):
+    result["group"] = np.datetime_as_string(result["group"])
+  names = list(result)
+  rounded = [name for name in names if name == "revenue" or name.startswith("p")]
+  records = []
+  for row in zip(*(result[name].tolist() for name in names)):
+    record = dict(zip(names, row))
+    group = record.pop("group")
+    if by != "all":
+      record[by if by in ("day", "week", "month") else by + "_id"] = group
+    for name in rounded:
+      record[name] = round(record[name], 2)
+    records.append(record)
+  return records
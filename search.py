@@ -0,0 +1,558 @@
+#------------------------------------------------------------------------------------------------------
+#                                   Product Indexes
+# the in-memory indexes behind /products/search, /products/autocomplete and /products/<id>/related.
+# Each index is built from rows app.py loads for it (the load function it is created with) and is
+# kept up to date by the write hooks in app.py between builds. A BackgroundIndex builds a new copy
+# in a background thread while lookups keep using the one it has, and swaps the new one in when it
+# is done, so no request waits for a rebuild. Writes that land during the build are replayed on the
+# new copy before the swap.
+import bisect
+import heapq
+import itertools
+import math
+import operator
+import re
+import threading
+import time
+from array import array
+
+token_pattern = re.compile(r"[a-z0-9]+")
+
+def tokenize(value):
+  return token_pattern.findall(value.lower()) if value else []
+
+
+class BackgroundIndex:
+  # app.config setting with the seconds a build is used for before the next lookup starts a new one
+  max_age_setting = None
+  # a lookup waits for the worker's first build when this is set, otherwise it finds nothing until then
+  wait_for_first_build = False
+
+  def __init__(self, app, load):
+    self.app = app
+    self.load = load
+    self.lock = threading.RLock()
+    # what lookups read, None until the first build is in
+    self.data = None
+    self.built_at = None
+    self.expired = False
+    # writes made while a build runs, replayed on its result before it is swapped in. None when no build runs
+    self.journal = None
+    self.builder = None
+
+  def is_stale(self):
+    return self.built_at is None or self.expired or time.monotonic() - self.built_at > self.app.config[self.max_age_setting]
+
+  # the next lookup starts a build, after a change too big to apply as writes
+  def expire(self):
+    with self.lock:
+      self.expired = True
+
+  # starts a build when the index is stale and none is running, without INDEX_BACKGROUND_BUILDS it
+  # runs right here and lookups wait for it
+  def refresh(self):
+    with self.lock:
+      if self.journal is not None or not self.is_stale():
+        return
+      self.expired = False
+      self.journal = []
+      if self.app.config["INDEX_BACKGROUND_BUILDS"]:
+        self.builder = threading.Thread(target=self.build_in_background, name=type(self).__name__, daemon=True)
+        self.builder.start()
+        return
+      try:
+        self.swap(self.build(self.load()))
+      finally:
+        self.journal = None
+
+  def build_in_background(self):
+    try:
+      with self.app.app_context():
+        data = self.build(self.load())
+    except Exception:
+      self.app.logger.exception("Building the %s failed", type(self).__name__)
+      with self.lock:
+        self.journal = None
+      return
+    self.swap(data)
+
+  def replay(self, data, journal):
+    for name, args in journal:
+      getattr(data, name)(*args)
+
+  def swap(self, data):
+    with self.lock:
+      self.replay(data, self.journal)
+      self.data = data
+      self.built_at = time.monotonic()
+      self.journal = None
+
+  # blocks until the build that is running, if any, has been swapped in
+  def wait(self):
+    builder = self.builder
+    if builder is not None:
+      builder.join()
+
+  def current(self):
+    self.refresh()
+    if self.data is None and self.wait_for_first_build:
+      self.wait()
+    return self.data
+
+  # applies a write to the index in use and keeps it for the build that is running. The writes are
+  # replayed by name with plain values, a build can finish long after the request's objects are gone
+  def write(self, name, *args):
+    with self.lock:
+      if self.data is not None:
+        getattr(self.data, name)(*args)
+      if self.journal is not None:
+        self.journal.append((name, args))
+
+
+# the order lines a build loaded, sorted by order id. They are kept until the order writes journaled
+# while it ran are replayed, to tell which of them the load saw.
+class OrderLines:
+  def __init__(self):
+    self.order_ids = array("i")
+    self.product_ids = array("i")
+    self.quantities = array("i")
+
+  def append(self, order_id, product_id, quantity):
+    self.order_ids.append(order_id)
+    self.product_ids.append(product_id)
+    self.quantities.append(quantity)
+
+  # product id -> quantity on an order as the load saw it
+  def lines(self, order_id):
+    start = bisect.bisect_left(self.order_ids, order_id)
+    end = bisect.bisect_right(self.order_ids, order_id, start)
+    return dict(zip(self.product_ids[start:end], self.quantities[start:end]))
+
+  # writes are (order id, lines before, lines after) in journal order. Returns order id -> (lines the
+  # load saw, lines after the last write) for the orders written. The journal opens before the load
+  # reads, so a write that committed in between was both loaded and journaled: an order's writes are
+  # followed from the lines the load saw, taking the one whose lines before match each time, so a
+  # write the load saw is never applied twice. Two writes to one order journaled in the other order
+  # than they committed are still followed right.
+  def settle(self, writes):
+    pending = {}
+    for order_id, before, after in writes:
+      pending.setdefault(order_id, []).append((before, after))
+    settled = {}
+    for order_id, steps in pending.items():
+      seen = current = self.lines(order_id)
+      while True:
+        step = next((step for step in steps if step[0] == current), None)
+        if step is None:
+          break
+        steps.remove(step)
+        current = step[1]
+      settled[order_id] = (seen, current)
+    return settled
+
+
+# an index kept up to date by order writes. record_order() journals an order's lines before and after
+# a write rather than the change it makes, the build keeps the lines it loaded on its result (the
+# data's loaded attribute) and the order writes are replayed as the change from what the load saw.
+class OrderIndex(BackgroundIndex):
+  def replay(self, data, journal):
+    writes = [args for name, args in journal if name == "record_order"]
+    for order_id, (seen, current) in data.loaded.settle(writes).items():
+      data.record_order(order_id, seen, current)
+    data.loaded = None
+    super().replay(data, [(name, args) for name, args in journal if name != "record_order"])
+
+  # previous and current map product id -> quantity for the lines of one order before and after a write
+  def record_order(self, order_id, previous, current):
+    self.write("record_order", order_id, dict(previous), dict(current))
+
+
+def term_frequencies(name, description, name_weight):
+  frequencies = {}
+  for token in tokenize(name):
+    frequencies[token] = frequencies.get(token, 0) + name_weight
+  for token in tokenize(description):
+    frequencies[token] = frequencies.get(token, 0) + 1
+  return frequencies
+
+
+# /products/search ranks products against the query words with BM25, words in the name count three
+# times as much as words in the description. A word's part of the score besides its idf (its impact)
+# is worked out when a product is added. Each word keeps its postings twice: in doc order, to look up
+# a product's impact with bisect, and in impact order, best first. Words in a quarter of the products
+# or more also keep their impacts in an array indexed by doc number, a lookup there is cheaper than
+# a bisect. A search reads blocks of the query words' impact ordered postings, the word whose next
+# posting is worth most first, works out the exact score of the products it hasn't scored yet with
+# map() so the loop runs in C, and keeps the k best. It stops as soon as no product it hasn't read
+# can beat the k-th best (the threshold algorithm), so a search reads the best few postings of each
+# word rather than all of them. Every product write appends a fresh document number and marks the
+# old one dead, dead ones are skipped while searching and gone after a rebuild.
+class Postings:
+  name_weight = 3
+  k1 = 1.2
+  b = 0.75
+  # postings read from a word in its first block, every later block is twice as big
+  first_block = 64
+
+  def __init__(self, average_length):
+    # token -> (doc numbers ascending, their impacts, doc numbers best impact first, their impacts,
+    # impact by doc number or None), equal impacts in doc order
+    self.terms = {}
+    # the impact by doc number arrays, every write adds a doc to each of them
+    self.dense = []
+    self.doc_products = array("i")
+    # product id -> its current doc number, and the doc numbers that were replaced or removed
+    self.live = {}
+    self.dead = set()
+    # the average document length when the index was built, kept for the impacts of later writes
+    self.average_length = average_length
+
+  def impact(self, frequency, length):
+    return frequency * (self.k1 + 1) / (frequency + self.k1 * (1 - self.b + self.b * length / self.average_length))
+
+  def add(self, product_id, name, description):
+    frequencies = term_frequencies(name, description, self.name_weight)
+    length = sum(frequencies.values())
+    self.remove(product_id)
+    doc = len(self.doc_products)
+    self.doc_products.append(product_id)
+    self.live[product_id] = doc
+    for impacts in self.dense:
+      impacts.append(0.0)
+    for token, frequency in frequencies.items():
+      term = self.terms.get(token)
+      if term is None:
+        term = self.terms[token] = (array("i"), array("f"), array("i"), array("f"), None)
+      docs, impacts, ranked_docs, ranked_impacts, dense = term
+      docs.append(doc)
+      impacts.append(self.impact(frequency, length))
+      # the impact as stored, and the new doc number is the highest so it goes after equal impacts
+      position = bisect.bisect_right(ranked_impacts, -impacts[-1], key=operator.neg)
+      ranked_docs.insert(position, doc)
+      ranked_impacts.insert(position, impacts[-1])
+      if dense is not None:
+        dense[doc] = impacts[-1]
+
+  def remove(self, product_id):
+    doc = self.live.pop(product_id, None)
+    if doc is not None:
+      self.dead.add(doc)
+
+  # the scores of a list of docs
+  def scores(self, terms, docs):
+    total = None
+    for idf, term_docs, impacts, ranked_docs, ranked_impacts, dense in terms:
+      if dense is not None:
+        part = map(operator.mul, map(dense.__getitem__, docs), itertools.repeat(idf))
+      else:
+        # a doc the word isn't in lands on a neighbour's posting, or past the end, and counts 0
+        last = len(term_docs) - 1
+        positions = list(map(min, map(bisect.bisect_left, itertools.repeat(term_docs), docs), itertools.repeat(last)))
+        found = map(operator.eq, map(term_docs.__getitem__, positions), docs)
+        part = map(operator.mul, map(operator.mul, map(impacts.__getitem__, positions), found), itertools.repeat(idf))
+      total = list(part) if total is None else list(map(operator.add, total, part))
+    return total
+
+  # product ids of the k best matches, best first, ties go to the lower doc number
+  def top(self, query, k):
+    count = len(self.live)
+    terms = []
+    for token in sorted(set(tokenize(query))):
+      term = self.terms.get(token)
+      if term is not None:
+        # postings of replaced documents are counted until the next build
+        matches = min(len(term[0]), count)
+        terms.append((math.log(1 + (count - matches + 0.5) / (matches + 0.5)),) + term)
+    # (score, -doc) of the k best so far, best first
+    best = []
+    scored = set()
+    depths = [0] * len(terms)
+    blocks = [self.first_block] * len(terms)
+    while k:
+      # the most a word's unread postings add, their sum is the most a doc not read yet can score
+      threshold = 0.0
+      number = None
+      last = -1
+      for position, (idf, docs, impacts, ranked_docs, ranked_impacts, dense) in enumerate(terms):
+        depth = depths[position]
+        if depth < len(ranked_docs):
+          bound = idf * ranked_impacts[depth]
+          threshold += bound
+          last = max(last, ranked_docs[depth])
+          if number is None or bound > best_bound:
+            number, best_bound = position, bound
+      if number is None:
+        break
+      # a doc not read yet may still tie the k-th best, it only wins the tie with a lower doc number
+      if len(best) == k and (threshold < best[-1][0] or threshold == best[-1][0] and last > -best[-1][1]):
+        break
+      ranked_docs = terms[number][3]
+      start = depths[number]
+      depths[number] = min(start + blocks[number], len(ranked_docs))
+      blocks[number] *= 2
+      new = set(ranked_docs[start:depths[number]])
+      new -= scored
+      scored |= new
+      new -= self.dead
+      if new:
+        new = list(new)
+        scores = self.scores(terms, new)
+        best = heapq.nlargest(k, itertools.chain(best, zip(scores, map(operator.neg, new))))
+    return [self.doc_products[-doc] for score, doc in best]
+
+
+# rebuilt every SEARCH_INDEX_MAX_AGE seconds to pick up other workers' writes, and sooner once most of
+# its documents have been replaced. load() returns (id, name, description) rows.
+class SearchIndex(BackgroundIndex):
+  max_age_setting = "SEARCH_INDEX_MAX_AGE"
+  # a search has to see every product, not the ones written since the worker started
+  wait_for_first_build = True
+
+  def is_stale(self):
+    return super().is_stale() or len(self.data.doc_products) > 2 * len(self.data.live) + 1000
+
+  def build(self, rows):
+    doc_products = array("i")
+    lengths = array("i")
+    # token -> (doc numbers, term frequencies), turned into impacts once the average length is known
+    frequencies_by_token = {}
+    for product_id, name, description in rows:
+      frequencies = term_frequencies(name, description, Postings.name_weight)
+      doc = len(doc_products)
+      doc_products.append(product_id)
+      lengths.append(sum(frequencies.values()))
+      for token, frequency in frequencies.items():
+        posting = frequencies_by_token.get(token)
+        if posting is None:
+          posting = frequencies_by_token[token] = (array("i"), array("i"))
+        posting[0].append(doc)
+        posting[1].append(frequency)
+    postings = Postings(sum(lengths) / len(lengths) if lengths else 1.0)
+    postings.doc_products = doc_products
+    postings.live = {product_id: doc for doc, product_id in enumerate(doc_products)}
+    for token in list(frequencies_by_token):
+      docs, frequencies = frequencies_by_token.pop(token)
+      impacts = array("f", (postings.impact(frequency, lengths[doc]) for doc, frequency in zip(docs, frequencies)))
+      # sorted() is stable with reverse=True too, so equal impacts stay in doc order
+      ranked = sorted(range(len(docs)), key=impacts.__getitem__, reverse=True)
+      dense = None
+      if 4 * len(docs) >= len(doc_products):
+        dense = array("f", bytes(4 * len(doc_products)))
+        for doc, impact in zip(docs, impacts):
+          dense[doc] = impact
+        postings.dense.append(dense)
+      postings.terms[token] = (docs, impacts, array("i", map(docs.__getitem__, ranked)), array("f", map(impacts.__getitem__, ranked)), dense)
+    return postings
+
+  def add(self, product):
+    self.write("add", product.id, product.name, product.description)
+
+  def remove(self, product_id):
+    self.write("remove", product_id)
+
+  # the products on the page and how many were found, which is more than offset + limit when there is a next page
+  def search(self, query, offset, limit):
+    postings = self.current()
+    if postings is None:
+      return [], 0
+    with self.lock:
+      found = postings.top(query, offset + limit + 1)
+    return found[offset:offset + limit], len(found)
+
+
+# product names are kept lower cased in one sorted list, the names starting with a prefix are a
+# contiguous slice of it found with bisect. Suggestions are ranked by units sold. Prefixes of up
+# to cached_prefix_length letters match too many names to rank on every keystroke, so their
+# suggestions are cached and dropped whenever a name or sales count under them changes.
+class Names:
+  cached_prefix_length = 3
+
+  def __init__(self, names, sales, loaded=None):
+    # product id -> name as stored
+    self.names = names
+    # sorted (lower cased name, product id)
+    self.keys = sorted((name.lower(), product_id) for product_id, name in names.items())
+    # product id -> units sold
+    self.sales = sales
+    self.cached = {}
+    # the OrderLines of the build, until it is swapped in
+    self.loaded = loaded
+
+  def forget_prefixes(self, name):
+    name = name.lower()
+    for length in range(self.cached_prefix_length + 1):
+      self.cached.pop(name[:length], None)
+
+  def add(self, product_id, name):
+    self.remove(product_id)
+    self.names[product_id] = name
+    bisect.insort(self.keys, (name.lower(), product_id))
+    self.forget_prefixes(name)
+
+  def remove(self, product_id):
+    name = self.names.pop(product_id, None)
+    if name is not None:
+      key = (name.lower(), product_id)
+      position = bisect.bisect_left(self.keys, key)
+      if position < len(self.keys) and self.keys[position] == key:
+        del self.keys[position]
+      self.forget_prefixes(name)
+
+  # the order id only matters to the replay of a build's journal
+  def record_order(self, order_id, previous, current):
+    for product_id in {**previous, **current}:
+      units = current.get(product_id, 0) - previous.get(product_id, 0)
+      if units:
+        self.sales[product_id] = self.sales.get(product_id, 0) + units
+        if product_id in self.names:
+          self.forget_prefixes(self.names[product_id])
+
+  def suggest(self, prefix, count):
+    suggestions = self.cached.get(prefix)
+    if suggestions is None:
+      start = bisect.bisect_left(self.keys, (prefix,))
+      end = bisect.bisect_left(self.keys, (prefix + "\uffff",))
+      ranked = heapq.nsmallest(count, self.keys[start:end], key=lambda key: (-self.sales.get(key[1], 0), key))
+      suggestions = [{"id": product_id, "name": self.names[product_id]} for name, product_id in ranked]
+      if len(prefix) <= self.cached_prefix_length:
+        self.cached[prefix] = suggestions
+    return suggestions
+
+
+# rebuilt every AUTOCOMPLETE_INDEX_MAX_AGE seconds to pick up other workers' writes. load() returns
+# the (id, name) rows of every product and the (order id, product id, quantity) rows of every order
+# line sorted by order id.
+class AutocompleteIndex(OrderIndex):
+  max_age_setting = "AUTOCOMPLETE_INDEX_MAX_AGE"
+  wait_for_first_build = True
+
+  def build(self, rows):
+    names, lines = rows
+    loaded = OrderLines()
+    sales = {}
+    for order_id, product_id, quantity in lines:
+      loaded.append(order_id, product_id, quantity)
+      sales[product_id] = sales.get(product_id, 0) + quantity
+    return Names({product_id: name for product_id, name in names}, sales, loaded)
+
+  def add(self, product):
+    self.write("add", product.id, product.name)
+
+  def remove(self, product_id):
+    self.write("remove", product_id)
+
+  def suggest(self, prefix, limit):
+    names = self.current()
+    if names is None:
+      return []
+    with self.lock:
+      return names.suggest(prefix.lower(), self.app.config["AUTOCOMPLETE_LIMIT"])[:limit]
+
+
+# counts how many orders every two products were bought in together. Each product keeps its row of
+# the (sparse) count matrix as two int arrays sorted by neighbour id, order writes adjust the counts
+# in place. A product's best top_k neighbours are picked the first time they are asked for and kept
+# up to date as counts grow, so a lookup is O(K).
+class PairCounts:
+  def __init__(self, rows, top_k, max_order_lines, loaded=None):
+    # product id -> (neighbour ids, counts)
+    self.rows = rows
+    # product id -> [(neighbour id, count)] best first
+    self.top = {}
+    self.top_k = top_k
+    self.max_order_lines = max_order_lines
+    # the OrderLines of the build, until it is swapped in
+    self.loaded = loaded
+
+  def bump(self, product_id, neighbour_id, change):
+    neighbour_ids, counts = self.rows.setdefault(product_id, (array("i"), array("i")))
+    position = bisect.bisect_left(neighbour_ids, neighbour_id)
+    if position < len(neighbour_ids) and neighbour_ids[position] == neighbour_id:
+      counts[position] += change
+    elif change > 0:
+      neighbour_ids.insert(position, neighbour_id)
+      counts.insert(position, change)
+    else:
+      return
+    top = self.top.get(product_id)
+    if top is None:
+      return
+    if change < 0:
+      # a neighbour that drops may fall behind one we don't keep, pick again on the next lookup
+      del self.top[product_id]
+    else:
+      top = [entry for entry in top if entry[0] != neighbour_id]
+      top.append((neighbour_id, counts[position]))
+      top.sort(key=lambda entry: (-entry[1], entry[0]))
+      self.top[product_id] = top[:self.top_k]
+
+  # the order id only matters to the replay of a build's journal
+  def record_order(self, order_id, previous, current):
+    changes = {}
+    for product_ids, sign in ((previous, -1), (current, 1)):
+      if len(product_ids) <= self.max_order_lines:
+        for pair in itertools.permutations(product_ids, 2):
+          changes[pair] = changes.get(pair, 0) + sign
+    for (product_id, neighbour_id), change in changes.items():
+      if change:
+        self.bump(product_id, neighbour_id, change)
+
+  def remove(self, product_id):
+    neighbour_ids, counts = self.rows.pop(product_id, ((), ()))
+    self.top.pop(product_id, None)
+    for neighbour_id, count in zip(neighbour_ids, counts):
+      self.bump(neighbour_id, product_id, -count)
+
+  def related(self, product_id):
+    top = self.top.get(product_id)
+    if top is None:
+      neighbour_ids, counts = self.rows.get(product_id, ((), ()))
+      top = heapq.nsmallest(self.top_k,
+        ((neighbour_id, count) for neighbour_id, count in zip(neighbour_ids, counts) if count > 0),
+        key=lambda entry: (-entry[1], entry[0]))
+      self.top[product_id] = top
+    return top
+
+
+# built in one pass over Order_Product and rebuilt every RELATED_INDEX_MAX_AGE seconds. Orders with
+# very many products are skipped, they add a pair for every two products in them and say little
+# about what goes together. load() returns the (order id, product id, quantity) rows of every order
+# line sorted by order id.
+class RelatedIndex(OrderIndex):
+  max_age_setting = "RELATED_INDEX_MAX_AGE"
+  # a product has no related products until the first build is in, a lookup never waits for one
+  wait_for_first_build = False
+
+  def build(self, rows):
+    loaded = OrderLines()
+    counts = {}
+    for order_id, group in itertools.groupby(rows, key=lambda line: line[0]):
+      product_ids = []
+      for order_id, product_id, quantity in group:
+        loaded.append(order_id, product_id, quantity)
+        product_ids.append(product_id)
+      if len(product_ids) > self.app.config["RELATED_MAX_ORDER_LINES"]:
+        continue
+      for product_id in product_ids:
+        row = counts.get(product_id)
+        if row is None:
+          row = counts[product_id] = {}
+        for neighbour_id in product_ids:
+          if neighbour_id != product_id:
+            row[neighbour_id] = row.get(neighbour_id, 0) + 1
+    pairs = {}
+    for product_id in list(counts):
+      row = counts.pop(product_id)
+      neighbour_ids = sorted(row)
+      pairs[product_id] = (array("i", neighbour_ids), array("i", [row[neighbour_id] for neighbour_id in neighbour_ids]))
+    return PairCounts(pairs, self.app.config["RELATED_TOP_K"], self.app.config["RELATED_MAX_ORDER_LINES"], loaded)
+
+  def remove(self, product_id):
+    self.write("remove", product_id)
+
+  def related(self, product_id, limit):
+    counts = self.current()
+    if counts is None:
+      return []
+    with self.lock:
+      return counts.related(product_id)[:limit]
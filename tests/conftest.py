@@ -0,0 +1,45 @@
+import pytest
+from app import create_app, db
+
+
+# a fresh in-memory SQLite database for every test. Flask-SQLAlchemy gives it a StaticPool, so
+# every request of the test sees the same database
+@pytest.fixture
+def app():
+  app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite://", "HOLD_SWEEP_INTERVAL": 0, "QUERY_STATS": True})
+  with app.app_context():
+    db.create_all(bind_key=None)
+  return app
+
+@pytest.fixture
+def client(app):
+  return app.test_client()
+
+
+def add_products(client, count, quantity=1000, price=10.0):
+  for number in range(count):
+    response = client.post("/products", json={"name": "product %d" % number, "price": price, "quantity": quantity, "description": "x"})
+    assert response.status_code == 201
+  return list(range(1, count + 1))
+
+def add_customers(client, count):
+  for number in range(count):
+    response = client.post("/customers", json={"name": "customer %d" % number, "email": "c%d@example.com" % number, "phone": "555"})
+    assert response.status_code == 201
+  return list(range(1, count + 1))
+
+def query_count(response):
+  return int(response.headers["X-Query-Count"])
+
+# every unit of a product is either in stock, on an order or held for a cart
+def assert_stock_accounted(app, initial):
+  from app import db, order_product, Product, StockHold
+  with app.app_context():
+    stock = dict(db.session.execute(db.select(Product.id, Product.quantity)).all())
+    ordered = dict(db.session.execute(db.select(order_product.c.product_id, db.func.sum(order_product.c.quantity))
+      .group_by(order_product.c.product_id)).all())
+    held = dict(db.session.execute(db.select(StockHold.product_id, db.func.sum(StockHold.quantity))
+      .group_by(StockHold.product_id)).all())
+  for product_id, quantity in initial.items():
+    assert stock[product_id] >= 0
+    assert stock[product_id] + ordered.get(product_id, 0) + held.get(product_id, 0) == quantity, product_id
@@ -0,0 +1,69 @@
+import pytest
+from app import create_app, db
+from cache import LocalCache, ProductCache
+from conftest import add_customers, add_products, query_count
+
+
+# the product cache on a LocalCache the test can look into
+@pytest.fixture
+def cached():
+  backend = LocalCache(100, 60)
+  app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite://", "HOLD_SWEEP_INTERVAL": 0, "QUERY_STATS": True,
+    "PRODUCT_CACHE_BACKEND": backend})
+  with app.app_context():
+    db.create_all(bind_key=None)
+  return app, app.test_client(), backend
+
+def test_product_reads_go_through_the_cache(cached):
+  app, client, backend = cached
+  add_products(client, 1)
+  first = client.get("/products/1")
+  assert first.status_code == 200
+  assert query_count(first) == 1
+  second = client.get("/products/1")
+  assert second.get_json() == first.get_json()
+  assert query_count(second) == 0
+  assert 1 in backend.entries
+  cache = app.extensions["product_cache"]
+  assert (cache.hits, cache.misses) == (1, 1)
+  # a product that isn't there isn't cached
+  assert client.get("/products/2").status_code == 404
+  assert 2 not in backend.entries
+
+def test_writes_invalidate_the_products_they_touch(cached):
+  app, client, backend = cached
+  add_products(client, 3, quantity=10)
+  add_customers(client, 1)
+  for product_id in (1, 2, 3):
+    client.get("/products/%d" % product_id)
+  assert client.put("/products/1", json={"name": "renamed", "price": 2.0, "quantity": 10, "description": "x"}).status_code == 200
+  assert 1 not in backend.entries
+  assert client.get("/products/1").get_json()["name"] == "renamed"
+  response = client.post("/orders", json={"customer_id": 1, "products": [{"product_id": 2, "quantity": 4}]})
+  assert response.status_code == 201
+  assert 2 not in backend.entries
+  assert 3 in backend.entries
+  assert client.get("/products/2").get_json()["quantity"] == 6
+  assert client.put("/orders/1", json={"customer_id": 1, "products": [{"product_id": 2, "quantity": 1}]}).status_code == 200
+  assert client.get("/products/2").get_json()["quantity"] == 9
+  assert client.delete("/orders/1").status_code == 200
+  assert client.get("/products/2").get_json()["quantity"] == 10
+  assert client.delete("/products/3").status_code == 200
+  assert client.get("/products/3").status_code == 404
+
+# a write committed while a miss was being loaded invalidates the product before the load is
+# stored, the load may have read the row before the write
+def test_a_load_that_raced_a_write_is_not_stored():
+  cache = ProductCache({"PRODUCT_CACHE_BACKEND": LocalCache(100, 60)})
+  def racing_load():
+    cache.invalidate(1)
+    return {"id": 1, "name": "old"}
+  assert cache.load(1, racing_load) == {"id": 1, "name": "old"}
+  assert cache.load(1, lambda: {"id": 1, "name": "new"}) == {"id": 1, "name": "new"}
+  assert cache.load(1, lambda: {"id": 1, "name": "not read"}) == {"id": 1, "name": "new"}
+  # clear() drops a racing load too
+  def cleared_load():
+    cache.clear()
+    return {"id": 2}
+  cache.load(2, cleared_load)
+  assert cache.get_backend().get(2) is None
@@ -0,0 +1,28 @@
+from conftest import add_customers, add_products, query_count
+
+
+def add_carts(client, count):
+  for number in range(count):
+    items = [{"product_id": 1 + (number + offset) % 5, "quantity": 1} for offset in range(3)]
+    assert client.post("/cart", json={"customer_id": 1 + number % 3, "items": items}).status_code == 201
+
+# listing carts loads their items and products up front, so the query count doesn't grow with the carts
+def test_cart_listings_run_the_same_queries_for_2_and_200_carts(client):
+  add_products(client, 5)
+  add_customers(client, 3)
+  add_carts(client, 2)
+  few = {path: query_count(client.get(path)) for path in ("/carts?limit=500", "/carts_by_customer?limit=500", "/carts_by_customer/1?limit=500")}
+  add_carts(client, 198)
+  for path, count in few.items():
+    response = client.get(path)
+    assert response.status_code == 200
+    assert query_count(response) == count
+
+def test_cart_listing_shows_items_with_their_products(client):
+  add_products(client, 5)
+  add_customers(client, 3)
+  add_carts(client, 2)
+  carts = client.get("/carts").json
+  assert [cart["cart_id"] for cart in carts] == [1, 2]
+  assert [item["product_id"] for item in carts[1]["items"]] == [2, 3, 4]
+  assert carts[1]["items"][0]["name"] == "product 1"
@@ -0,0 +1,71 @@
+import random
+from app import db, release_expired_holds, Cart, CartItem, StockHold
+from conftest import add_customers, add_products, assert_stock_accounted
+
+
+def items(quantities):
+  return [{"product_id": product_id, "quantity": quantity} for product_id, quantity in quantities.items()]
+
+def holds(app, cart_id):
+  with app.app_context():
+    return dict(db.session.execute(db.select(StockHold.product_id, StockHold.quantity).where(StockHold.cart_id == cart_id)).all())
+
+def test_cart_holds_its_items_until_checkout(client, app):
+  add_products(client, 2, quantity=5)
+  add_customers(client, 2)
+  assert client.post("/cart", json={"customer_id": 1, "items": items({1: 4, 2: 1})}).status_code == 201
+  assert holds(app, 1) == {1: 4, 2: 1}
+  # another customer can't order the units held for the cart
+  assert client.post("/orders", json={"customer_id": 2, "products": items({1: 2})}).status_code == 409
+  assert client.post("/orders", json={"customer_id": 2, "products": items({1: 1}), "cart_id": 1}).status_code == 400
+  # the cart's own checkout uses the held units, the ones it doesn't order go back
+  assert client.post("/orders", json={"customer_id": 1, "products": items({1: 5}), "cart_id": 1}).status_code == 201
+  assert holds(app, 1) == {}
+  assert [client.get("/products/%d" % product_id).json["quantity"] for product_id in (1, 2)] == [0, 5]
+  assert_stock_accounted(app, {1: 5, 2: 5})
+
+def test_changing_or_emptying_a_cart_gives_units_back(client, app):
+  add_products(client, 2, quantity=10)
+  add_customers(client, 1)
+  client.post("/cart", json={"customer_id": 1, "items": items({1: 3, 2: 3})})
+  assert client.put("/cart/1", json={"items": items({1: 8, 2: 0})}).status_code == 200
+  assert holds(app, 1) == {1: 8}
+  assert client.put("/cart/1", json={"items": items({1: 11})}).status_code == 409
+  assert holds(app, 1) == {1: 8}
+  assert client.delete("/cart/1/item/1").status_code == 200
+  assert holds(app, 1) == {}
+  assert [client.get("/products/%d" % product_id).json["quantity"] for product_id in (1, 2)] == [10, 10]
+
+def test_expired_holds_are_released(client, app):
+  add_products(client, 1, quantity=10)
+  add_customers(client, 1)
+  app.config["CART_HOLD_TTL"] = 0
+  client.post("/cart", json={"customer_id": 1, "items": items({1: 6})})
+  with app.app_context():
+    assert release_expired_holds() == 1
+    assert release_expired_holds() == 0
+  assert client.get("/products/1").json["quantity"] == 10
+  assert_stock_accounted(app, {1: 10})
+
+def test_stock_stays_accounted_for_through_random_carts_and_checkouts(client, app):
+  rng = random.Random(11)
+  add_products(client, 4, quantity=20)
+  add_customers(client, 1)
+  for step in range(150):
+    action = rng.random()
+    quantities = {product_id: rng.randint(1, 6) for product_id in rng.sample(range(1, 5), rng.randint(1, 3))}
+    with app.app_context():
+      carts = db.session.scalars(db.select(Cart.id)).all()
+      cart_items = db.session.execute(db.select(CartItem.cart_id, CartItem.id)).all()
+    if action < 0.35 or not carts:
+      response = client.post("/cart", json={"customer_id": 1, "items": items(quantities)})
+    elif action < 0.55:
+      response = client.put("/cart/%d" % rng.choice(carts), json={"items": items({product_id: quantity - 1 for product_id, quantity in quantities.items()})})
+    elif action < 0.7:
+      response = client.post("/orders", json={"customer_id": 1, "products": items(quantities), "cart_id": rng.choice(carts)})
+    elif action < 0.85 and cart_items:
+      response = client.delete("/cart/%d/item/%d" % tuple(rng.choice(cart_items)))
+    else:
+      response = client.delete("/cart/%d" % rng.choice(carts))
+    assert response.status_code in (200, 201, 409)
+    assert_stock_accounted(app, {product_id: 20 for product_id in range(1, 5)})
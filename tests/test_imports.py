@@ -0,0 +1,67 @@
+import json
+import app as application
+from app import db, Customer, CustomerAccount
+
+
+def ndjson(rows):
+  return "\n".join(json.dumps(row) for row in rows)
+
+def customer(number, username=None):
+  row = {"name": "customer %d" % number, "email": "c%d@example.com" % number, "phone": "555"}
+  if username:
+    row["account"] = {"username": username, "password": "secret %d" % number}
+  return row
+
+# username -> the email of the customer its account belongs to
+def accounts(app):
+  with app.app_context():
+    return dict(db.session.execute(db.select(CustomerAccount.username, Customer.email)
+      .join(Customer, CustomerAccount.customer_id == Customer.id)).all())
+
+def customer_emails(app):
+  with app.app_context():
+    return db.session.scalars(db.select(Customer.email).order_by(Customer.id)).all()
+
+def test_bulk_import_links_each_account_to_its_own_customer(app, client):
+  app.config["BULK_IMPORT_CHUNK_SIZE"] = 3
+  rows = [customer(1, "one"), customer(2), customer(3, "three"), customer(4, "one"), customer(5, "five"), customer(6, "six")]
+  response = client.post("/customers/bulk", data=ndjson(rows), content_type="application/x-ndjson")
+  assert response.status_code == 200
+  assert response.get_json() == {"imported": 5, "error_count": 1,
+    "errors": [{"row": 4, "errors": {"account": {"username": ["Username already taken"]}}}]}
+  assert customer_emails(app) == ["c1@example.com", "c2@example.com", "c3@example.com", "c5@example.com", "c6@example.com"]
+  assert accounts(app) == {"one": "c1@example.com", "three": "c3@example.com", "five": "c5@example.com", "six": "c6@example.com"}
+  # a username taken by an earlier import, and CSV login columns
+  csv = "name,email,phone,username,password\ncustomer 7,c7@example.com,555,six,x\ncustomer 8,c8@example.com,555,eight,x\n"
+  response = client.post("/customers/bulk", data=csv, content_type="text/csv")
+  assert response.get_json()["error_count"] == 1
+  assert accounts(app)["eight"] == "c8@example.com"
+  assert accounts(app)["six"] == "c6@example.com"
+
+def test_checkpointed_import_resumes_after_the_last_committed_chunk(app, client, monkeypatch):
+  app.config["BULK_IMPORT_CHUNK_SIZE"] = 2
+  rows = [customer(number, "user%d" % number) for number in range(1, 8)]
+  insert_returning_ids = application.insert_returning_ids
+  calls = []
+  # the second chunk fails after the first one was committed
+  def failing_insert(table, rows):
+    calls.append(len(rows))
+    if len(calls) == 2:
+      raise RuntimeError("connection lost")
+    return insert_returning_ids(table, rows)
+  monkeypatch.setattr(application, "insert_returning_ids", failing_insert)
+  response = client.post("/customers/bulk?checkpoint=nightly", data=ndjson(rows), content_type="application/x-ndjson")
+  assert response.status_code == 500
+  assert customer_emails(app) == ["c1@example.com", "c2@example.com"]
+  monkeypatch.setattr(application, "insert_returning_ids", insert_returning_ids)
+  response = client.post("/customers/bulk?checkpoint=nightly", data=ndjson(rows), content_type="application/x-ndjson")
+  assert response.get_json() == {"imported": 5, "error_count": 0, "errors": [], "resumed_after": 2}
+  assert customer_emails(app) == ["c%d@example.com" % number for number in range(1, 8)]
+  assert accounts(app) == {"user%d" % number: "c%d@example.com" % number for number in range(1, 8)}
+  # done, sending it again imports nothing
+  response = client.post("/customers/bulk?checkpoint=nightly", data=ndjson(rows), content_type="application/x-ndjson")
+  assert response.get_json() == {"imported": 0, "error_count": 0, "errors": [], "resumed_after": 7}
+  # another name starts from the top, and every username is taken by then
+  response = client.post("/customers/bulk?checkpoint=other", data=ndjson(rows), content_type="application/x-ndjson")
+  assert response.get_json()["resumed_after"] == 0
+  assert response.get_json()["error_count"] == 7
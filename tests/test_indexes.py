@@ -0,0 +1,18 @@
+import pytest
+from app import db, full_scans, hot_queries, Customer
+
+
+# the same check as `flask check-indexes`, on SQLite
+@pytest.mark.parametrize("name", sorted(hot_queries()))
+def test_hot_query_uses_an_index(app, name):
+  with app.app_context():
+    assert full_scans(hot_queries()[name]) == []
+
+def test_full_scans_names_a_table_read_in_full(app):
+  with app.app_context():
+    assert full_scans(db.select(Customer).where(Customer.phone == "555")) == ["Customers"]
+
+def test_check_indexes_command_passes(app):
+  result = app.test_cli_runner().invoke(args=["check-indexes"])
+  assert result.exit_code == 0, result.output
+  assert "FAIL" not in result.output
@@ -0,0 +1,41 @@
+import pytest
+import querystats
+from app import db, Product
+from conftest import add_customers, add_products
+
+
+@pytest.fixture
+def strict(app):
+  app.config.update(QUERY_STRICT=True, TESTING=True)
+  return app.test_client()
+
+# every route below handles eight lines or items, a statement run once per line would raise
+def test_order_and_cart_routes_pass_strict_mode(strict):
+  add_products(strict, 8)
+  add_customers(strict, 2)
+  lines = [{"product_id": product_id, "quantity": 1} for product_id in range(1, 9)]
+  assert strict.post("/orders", json={"customer_id": 1, "products": lines}).status_code == 201
+  assert strict.post("/cart", json={"customer_id": 1, "items": lines}).status_code == 201
+  assert strict.post("/orders", json={"customer_id": 1, "products": lines, "cart_id": 1}).status_code == 201
+  assert strict.post("/cart", json={"customer_id": 2, "items": lines}).status_code == 201
+  more = [{"product_id": product_id, "quantity": 2} for product_id in range(1, 9)]
+  assert strict.put("/orders/1", json={"customer_id": 1, "products": more}).status_code == 200
+  assert strict.put("/cart/2", json={"items": more}).status_code == 200
+  for path in ("/orders", "/orders/1", "/orders/by_customer_id/1", "/carts", "/cart/2", "/carts_by_customer",
+      "/products", "/products/1", "/customers", "/analytics/sales", "/analytics/sales/products"):
+    assert strict.get(path).status_code == 200, path
+  assert strict.delete("/cart/2").status_code == 200
+  assert strict.delete("/orders/1").status_code == 200
+
+def test_strict_mode_raises_on_a_query_per_row(app, strict):
+  @app.route("/names")
+  def names():
+    ids = db.session.scalars(db.select(Product.id)).all()
+    return {"names": [db.session.scalar(db.select(Product.name).where(Product.id == id)) for id in ids]}
+  add_products(strict, app.config["QUERY_REPEAT_THRESHOLD"])
+  with pytest.raises(querystats.RepeatedQueryError):
+    strict.get("/names")
+  app.config["QUERY_STRICT"] = False
+  response = strict.get("/names")
+  assert response.status_code == 200
+  assert response.headers["X-Query-Repeats"] == str(app.config["QUERY_REPEAT_THRESHOLD"])
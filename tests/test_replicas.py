@@ -0,0 +1,83 @@
+import sqlite3
+import pytest
+from app import create_app, db, ReplicaMonitor, sticky_cookie
+
+
+# a primary and a replica in two SQLite files. The replica only changes when replicate() copies the
+# primary over it, and the test runs the replica monitor's checks itself rather than in its thread
+@pytest.fixture
+def replica(tmp_path):
+  primary = tmp_path / "primary.db"
+  replica = tmp_path / "replica.db"
+  app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///%s" % primary, "SQLALCHEMY_BINDS": {"replica_0": "sqlite:///%s" % replica},
+    "HOLD_SWEEP_INTERVAL": 0, "INDEX_BACKGROUND_BUILDS": False})
+  with app.app_context():
+    db.create_all(bind_key=None)
+  app.extensions["replica_monitor"] = ReplicaMonitor(app)
+  def replicate():
+    source = sqlite3.connect(primary)
+    target = sqlite3.connect(replica)
+    source.backup(target)
+    source.close()
+    target.close()
+  def check():
+    with app.app_context():
+      app.extensions["replica_monitor"].check()
+  def execute(statement):
+    connection = sqlite3.connect(replica)
+    connection.execute(statement)
+    connection.commit()
+    connection.close()
+  # a beat written and read back, the replica is healthy
+  check()
+  replicate()
+  check()
+  replicate()
+  return app, replicate, check, execute
+
+def add_product(client, name):
+  response = client.post("/products", json={"name": name, "price": 1.0, "quantity": 1, "description": "x"})
+  assert response.status_code == 201
+  return response
+
+def product_names(client):
+  return [product["name"] for product in client.get("/products").get_json()]
+
+def test_reads_go_to_the_replica(replica):
+  app, replicate, check, execute = replica
+  assert app.extensions["replica_monitor"].healthy == ["replica_0"]
+  add_product(app.test_client(), "written")
+  # a client that hasn't written reads the replica, which doesn't have the product yet
+  assert product_names(app.test_client()) == []
+  replicate()
+  assert product_names(app.test_client()) == ["written"]
+
+def test_a_write_keeps_the_writers_reads_on_the_primary(replica):
+  app, replicate, check, execute = replica
+  writer = app.test_client()
+  response = add_product(writer, "written")
+  assert sticky_cookie in response.headers["Set-Cookie"]
+  assert product_names(writer) == ["written"]
+  assert product_names(app.test_client()) == []
+  # a request that fails writes nothing and sets no cookie
+  response = app.test_client().post("/products", json={"name": ""})
+  assert response.status_code == 400
+  assert "Set-Cookie" not in response.headers
+
+@pytest.mark.parametrize("statement", [
+  "UPDATE Replica_Heartbeat SET beat_ms = beat_ms - 60000",
+  "DELETE FROM Replica_Heartbeat",
+])
+def test_a_lagging_replica_gets_no_reads(replica, statement):
+  app, replicate, check, execute = replica
+  add_product(app.test_client(), "written")
+  execute(statement)
+  check()
+  monitor = app.extensions["replica_monitor"]
+  assert monitor.healthy == []
+  assert product_names(app.test_client()) == ["written"]
+  # caught up again
+  replicate()
+  check()
+  assert monitor.healthy == ["replica_0"]
+  assert monitor.lags["replica_0"] <= app.config["REPLICA_MAX_LAG"]
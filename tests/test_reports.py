@@ -0,0 +1,14 @@
+import pytest
+
+
+def test_sales_report_rejects_a_negative_top(client):
+  pytest.importorskip("numpy")
+  response = client.get("/reports/sales?top=-1")
+  assert response.status_code == 400
+  assert response.get_json() == {"message": "top must be 0 or more"}
+  assert client.get("/reports/sales?top=0").status_code == 200
+
+def test_report_command_rejects_a_negative_top(app):
+  result = app.test_cli_runner().invoke(args=["report", "--top", "-1"])
+  assert result.exit_code == 2
+  assert "--top" in result.output
@@ -0,0 +1,42 @@
+import random
+from app import db, rebuild_sales_rollups, CustomerSales, Order, ProductSales
+
+
+def rollups(app):
+  with app.app_context():
+    products = {(row.day, row.product_id): (row.units, round(row.revenue, 2))
+      for row in db.session.scalars(db.select(ProductSales))}
+    customers = {(row.day, row.customer_id): (row.orders, row.units, round(row.revenue, 2))
+      for row in db.session.scalars(db.select(CustomerSales))}
+  # a row taken back down to nothing stays behind as zeros, a rebuild doesn't write it
+  return ({key: value for key, value in products.items() if any(value)},
+    {key: value for key, value in customers.items() if any(value)})
+
+def test_incremental_rollups_match_a_rebuild(client, app):
+  rng = random.Random(3)
+  for number in range(5):
+    client.post("/products", json={"name": "product %d" % number, "price": 2.5 + number, "quantity": 1000, "description": "x"})
+  for number in range(3):
+    client.post("/customers", json={"name": "customer %d" % number, "email": "c%d@example.com" % number, "phone": "555"})
+  for step in range(120):
+    action = rng.random()
+    lines = [{"product_id": product_id, "quantity": rng.randint(1, 4)} for product_id in rng.sample(range(1, 6), rng.randint(1, 4))]
+    with app.app_context():
+      orders = db.session.scalars(db.select(Order.id)).all()
+    if action < 0.5 or not orders:
+      response = client.post("/orders", json={"customer_id": rng.randint(1, 3), "products": lines})
+    elif action < 0.75:
+      response = client.put("/orders/%d" % rng.choice(orders), json={"customer_id": rng.randint(1, 3), "products": lines})
+    elif action < 0.9:
+      response = client.delete("/orders/%d" % rng.choice(orders))
+    else:
+      # orders keep the price their lines were sold at
+      product_id = rng.randint(1, 5)
+      response = client.put("/products/%d" % product_id, json={"name": "product %d" % product_id, "price": rng.randint(1, 50) / 4,
+        "quantity": client.get("/products/%d" % product_id).json["quantity"], "description": "x"})
+    assert response.status_code in (200, 201)
+  incremental = rollups(app)
+  assert incremental[0] and incremental[1]
+  with app.app_context():
+    rebuild_sales_rollups()
+  assert rollups(app) == incremental
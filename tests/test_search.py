@@ -0,0 +1,168 @@
+import bisect
+import math
+import random
+from array import array
+import pytest
+from app import encode_cursor, load_autocomplete_names, load_order_pairs, load_search_documents
+from conftest import add_customers, add_products
+from search import Postings, SearchIndex, term_frequencies, tokenize
+
+
+def items(quantities):
+  return [{"product_id": product_id, "quantity": quantity} for product_id, quantity in quantities.items()]
+
+def related(client, product_id):
+  return [(product["id"], product["orders_together"]) for product in client.get("/products/%d/related" % product_id).get_json()]
+
+# rebuilds the index with a load that calls before() once the journal is open and before it reads,
+# and after() once it has read
+def rebuild(app, index, load, before=lambda: None, after=lambda: None):
+  def loader():
+    before()
+    rows = load()
+    rows = tuple(result.all() for result in rows) if isinstance(rows, tuple) else rows.all()
+    after()
+    return rows
+  index.load = loader
+  with app.app_context():
+    index.expire()
+    index.refresh()
+
+# product names and descriptions from a small vocabulary, the first words are in most products so
+# their impacts are kept in dense arrays, the last ones in a few
+def random_products(rng, count):
+  words = ["w%d" % number for number in range(40)]
+  weights = [1 / (number + 1) for number in range(40)]
+  return [(product_id, " ".join(rng.choices(words, weights, k=2)), " ".join(rng.choices(words, weights, k=rng.randint(0, 12))))
+    for product_id in range(1, count + 1)]
+
+def random_query(rng):
+  return " ".join(rng.choices(["w%d" % number for number in range(40)] + ["unknown"], k=rng.randint(1, 3)))
+
+# BM25 worked out for every product from scratch, impacts rounded to the index's float32
+def brute_force_top(rows, query, k):
+  documents = [term_frequencies(name, description, Postings.name_weight) for product_id, name, description in rows]
+  lengths = [sum(frequencies.values()) for frequencies in documents]
+  average_length = sum(lengths) / len(lengths)
+  scores = [None] * len(rows)
+  for token in sorted(set(tokenize(query))):
+    matches = sum(token in frequencies for frequencies in documents)
+    if not matches:
+      continue
+    idf = math.log(1 + (len(rows) - matches + 0.5) / (matches + 0.5))
+    for doc, frequencies in enumerate(documents):
+      frequency = frequencies.get(token, 0)
+      impact = array("f", [frequency * (Postings.k1 + 1) / (frequency + Postings.k1 * (1 - Postings.b + Postings.b * lengths[doc] / average_length))])[0]
+      part = impact * idf
+      scores[doc] = part if scores[doc] is None else scores[doc] + part
+  ranked = sorted((doc for doc, frequencies in enumerate(documents) if any(token in frequencies for token in tokenize(query))),
+    key=lambda doc: (-scores[doc], doc))
+  return [rows[doc][0] for doc in ranked[:k]]
+
+# the index's own impacts of the live documents, scored without the threshold algorithm
+def exhaustive_top(postings, query, k):
+  count = len(postings.live)
+  scores = {}
+  for token in sorted(set(tokenize(query))):
+    term = postings.terms.get(token)
+    if term is None:
+      continue
+    docs, impacts = term[0], term[1]
+    idf = math.log(1 + (count - min(len(docs), count) + 0.5) / (min(len(docs), count) + 0.5))
+    for doc in postings.live.values():
+      position = bisect.bisect_left(docs, doc)
+      if position < len(docs) and docs[position] == doc:
+        scores[doc] = scores.get(doc, 0.0) + impacts[position] * idf
+  ranked = sorted(scores, key=lambda doc: (-scores[doc], doc))
+  return [postings.doc_products[doc] for doc in ranked[:k]]
+
+def test_search_ranks_like_bm25():
+  rng = random.Random(7)
+  rows = random_products(rng, 600)
+  postings = SearchIndex(None, None).build(rows)
+  assert postings.dense and any(term[4] is None for term in postings.terms.values())
+  for number in range(200):
+    query = random_query(rng)
+    expected = brute_force_top(rows, query, len(rows))
+    for k in (1, 10, 100, 700):
+      assert postings.top(query, k) == expected[:k], (query, k)
+
+def test_search_after_writes_replayed_on_a_build(app, client):
+  rng = random.Random(8)
+  for product_id, name, description in random_products(rng, 300):
+    client.post("/products", json={"name": name, "price": 1.0, "quantity": 1, "description": description})
+  index = app.extensions["search_index"]
+  def write():
+    for product_id, name, description in random_products(rng, 60):
+      product_id = rng.randint(1, 300)
+      if rng.random() < 0.2:
+        client.delete("/products/%d" % product_id)
+      elif rng.random() < 0.5:
+        client.put("/products/%d" % product_id, json={"name": name, "price": 1.0, "quantity": 1, "description": description})
+      else:
+        client.post("/products", json={"name": name, "price": 1.0, "quantity": 1, "description": description})
+  # writes before the load read are loaded and replayed, writes after it only replayed
+  rebuild(app, index, load_search_documents, before=write, after=write)
+  write()
+  postings = index.data
+  assert len(postings.dead) > 0
+  for number in range(200):
+    query = random_query(rng)
+    expected = exhaustive_top(postings, query, len(postings.live))
+    for k in (1, 10, 100):
+      assert postings.top(query, k) == expected[:k], (query, k)
+
+def test_search_pages_follow_the_cursor(client):
+  for number in range(7):
+    client.post("/products", json={"name": "red %d" % number, "price": 1.0, "quantity": 1, "description": "red " * number + "wool"})
+  client.post("/products", json={"name": "blue", "price": 1.0, "quantity": 1, "description": "x"})
+  everything = [product["id"] for product in client.get("/products/search?q=red&limit=50").get_json()]
+  assert len(everything) == 7
+  pages = []
+  url = "/products/search?q=red&limit=3"
+  while url:
+    response = client.get(url)
+    assert response.status_code == 200
+    pages.append([product["id"] for product in response.get_json()])
+    cursor = response.headers.get("X-Next-Cursor")
+    url = cursor and "/products/search?q=red&limit=3&cursor=" + cursor
+  assert [len(page) for page in pages] == [3, 3, 1]
+  assert sum(pages, []) == everything
+
+@pytest.mark.parametrize("cursor", ["not a cursor!", encode_cursor({"offset": -3}), encode_cursor({"offset": "x"}),
+  encode_cursor([3]), encode_cursor({"page": 3})])
+def test_search_rejects_an_invalid_cursor(client, cursor):
+  add_products(client, 1)
+  response = client.get("/products/search", query_string={"q": "product", "cursor": cursor})
+  assert response.status_code == 400
+  assert response.get_json() == {"message": "Invalid cursor"}
+
+def test_related_order_written_while_the_index_loads_counts_once(app, client):
+  add_products(client, 3)
+  add_customers(client, 1)
+  index = app.extensions["related_index"]
+  rebuild(app, index, load_order_pairs,
+    before=lambda: client.post("/orders", json={"customer_id": 1, "products": items({1: 1, 2: 7})}))
+  assert related(client, 1) == [(2, 1)]
+  # committed after the load read, only the journal has it
+  rebuild(app, index, load_order_pairs,
+    after=lambda: client.put("/orders/1", json={"customer_id": 1, "products": items({1: 1, 3: 1})}))
+  assert related(client, 1) == [(3, 1)]
+  # committed before the load read and journaled, then changed again after it
+  rebuild(app, index, load_order_pairs,
+    before=lambda: client.put("/orders/1", json={"customer_id": 1, "products": items({1: 1, 2: 1})}),
+    after=lambda: client.delete("/orders/1"))
+  assert related(client, 1) == []
+  assert related(client, 2) == []
+
+def test_sales_written_while_the_autocomplete_index_loads_count_once(app, client):
+  add_products(client, 2)
+  add_customers(client, 1)
+  index = app.extensions["autocomplete_index"]
+  rebuild(app, index, load_autocomplete_names,
+    before=lambda: client.post("/orders", json={"customer_id": 1, "products": items({1: 1, 2: 7})}),
+    after=lambda: client.put("/orders/1", json={"customer_id": 1, "products": items({1: 3, 2: 7})}))
+  assert index.data.sales == {1: 3, 2: 7}
+  rebuild(app, index, load_autocomplete_names,
+    before=lambda: client.put("/orders/1", json={"customer_id": 1, "products": items({2: 2})}))
+  assert {product_id: units for product_id, units in index.data.sales.items() if units} == {2: 2}
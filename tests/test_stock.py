@@ -0,0 +1,84 @@
+import random
+import threading
+from app import create_app, db, order_product, Order
+from conftest import add_customers, add_products, assert_stock_accounted
+
+
+def lines(quantities):
+  return [{"product_id": product_id, "quantity": quantity} for product_id, quantity in quantities.items()]
+
+def test_order_takes_stock_and_refuses_what_is_not_there(client, app):
+  add_products(client, 2, quantity=5)
+  add_customers(client, 1)
+  assert client.post("/orders", json={"customer_id": 1, "products": lines({1: 3, 2: 1})}).status_code == 201
+  response = client.post("/orders", json={"customer_id": 1, "products": lines({1: 3, 2: 1})})
+  assert response.status_code == 409
+  assert response.json["lines"] == [{"product_id": 1, "requested": 3, "available": 2}]
+  # the refused order took nothing, not even the line there was stock for
+  assert [client.get("/products/%d" % product_id).json["quantity"] for product_id in (1, 2)] == [2, 4]
+  assert_stock_accounted(app, {1: 5, 2: 5})
+
+def test_order_lists_every_missing_product_and_merges_repeated_lines(client, app):
+  add_products(client, 2, quantity=10)
+  add_customers(client, 1)
+  products = [{"product_id": 9, "quantity": 1}, {"product_id": 1, "quantity": 1}, {"product_id": 7, "quantity": 2}, {"product_id": 9, "quantity": 1}]
+  response = client.post("/orders", json={"customer_id": 1, "products": products})
+  assert response.status_code == 404
+  assert response.json == {"message": "Products Not Found", "missing_product_ids": [7, 9]}
+  products = [{"product_id": 1, "quantity": 2}, {"product_id": 2, "quantity": 1}, {"product_id": 1, "quantity": 3}]
+  assert client.post("/orders", json={"customer_id": 1, "products": products}).status_code == 201
+  with app.app_context():
+    assert sorted(db.session.execute(db.select(order_product.c.product_id, order_product.c.quantity)).all()) == [(1, 5), (2, 1)]
+    assert db.session.get(Order, 1).item_count == 6
+  response = client.put("/orders/1", json={"customer_id": 1, "products": [{"product_id": 8, "quantity": 1}, {"product_id": 2, "quantity": 1}]})
+  assert response.status_code == 404
+  assert response.json["missing_product_ids"] == [8]
+  assert [client.get("/products/%d" % product_id).json["quantity"] for product_id in (1, 2)] == [5, 9]
+  assert_stock_accounted(app, {1: 10, 2: 10})
+
+def test_updating_and_deleting_orders_moves_stock_back(client, app):
+  add_products(client, 3, quantity=10)
+  add_customers(client, 1)
+  client.post("/orders", json={"customer_id": 1, "products": lines({1: 4, 2: 4})})
+  assert client.put("/orders/1", json={"customer_id": 1, "products": lines({2: 1, 3: 9})}).status_code == 200
+  assert [client.get("/products/%d" % product_id).json["quantity"] for product_id in (1, 2, 3)] == [10, 9, 1]
+  assert client.put("/orders/1", json={"customer_id": 1, "products": lines({3: 11})}).status_code == 409
+  assert client.delete("/orders/1").status_code == 200
+  assert [client.get("/products/%d" % product_id).json["quantity"] for product_id in (1, 2, 3)] == [10, 10, 10]
+
+def test_stock_stays_accounted_for_through_random_orders(client, app):
+  rng = random.Random(7)
+  add_products(client, 4, quantity=20)
+  add_customers(client, 2)
+  for step in range(150):
+    action = rng.random()
+    quantities = {product_id: rng.randint(1, 6) for product_id in rng.sample(range(1, 5), rng.randint(1, 3))}
+    with app.app_context():
+      orders = db.session.scalars(db.select(Order.id)).all()
+    if action < 0.5 or not orders:
+      response = client.post("/orders", json={"customer_id": 1, "products": lines(quantities)})
+    elif action < 0.8:
+      response = client.put("/orders/%d" % rng.choice(orders), json={"customer_id": 2, "products": lines(quantities)})
+    else:
+      response = client.delete("/orders/%d" % rng.choice(orders))
+    assert response.status_code in (200, 201, 409)
+    assert_stock_accounted(app, {product_id: 20 for product_id in range(1, 5)})
+
+# two updates of one order at once: the second waits for the first and works from its lines
+def test_concurrent_order_updates_keep_stock_accounted(tmp_path):
+  app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///%s" % (tmp_path / "orders.db"), "HOLD_SWEEP_INTERVAL": 0})
+  client = app.test_client()
+  add_products(client, 1, quantity=100)
+  add_customers(client, 1)
+  client.post("/orders", json={"customer_id": 1, "products": lines({1: 10})})
+  for quantity in range(20, 30):
+    barrier = threading.Barrier(2)
+    def update(quantity):
+      barrier.wait()
+      assert app.test_client().put("/orders/1", json={"customer_id": 1, "products": lines({1: quantity})}).status_code == 200
+    threads = [threading.Thread(target=update, args=(amount,)) for amount in (quantity, 30)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    assert_stock_accounted(app, {1: 100})